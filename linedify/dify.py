@@ -1,8 +1,8 @@
 from enum import Enum
-import json
-from logging import getLogger, NullHandler
-from typing import Dict, Tuple
+from logging import getLogger, NullHandler, DEBUG, INFO
+from typing import AsyncIterator, Callable, Dict, Tuple
 import aiohttp
+import orjson
 
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
@@ -13,18 +13,33 @@ class DifyType(Enum):
     TextGenerator = "TextGenerator"
     Workflow = "Workflow"
 
+def create_client_session(limit: int = 100) -> aiohttp.ClientSession:
+    # Dify向けのClientSession。接続プールの設定はここで一元管理する
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=limit,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,  # 接続先はDifyのみのため名前解決結果を長めに保持
+            enable_cleanup_closed=True  # 異常切断されたTLS接続を確実に解放
+        ),
+        # 応答が止まったリクエストで処理が詰まらないよう、全体のタイムアウトは有限に保つ
+        timeout=aiohttp.ClientTimeout(total=300, sock_connect=10)
+    )
+
 class DifyAgent:
     def __init__(self, *,
                 api_key: str,
                 base_url: str,
                 user: str,
                 type: DifyType = DifyType.Agent,
+                session_provider: Callable[[], aiohttp.ClientSession] = None,
                 verbose: bool = False) -> None:
         self.verbose = verbose
         self.api_key = api_key
         self.base_url = base_url
         self.user = user
         self.type = type
+        self._response_mode = "streaming" if type == DifyType.Agent else "blocking"
         self.response_processors = {
             DifyType.Agent: self.process_agent_response,
             DifyType.Chatbot: self.process_chatbot_response,
@@ -32,26 +47,54 @@ class DifyAgent:
             DifyType.Workflow: self.process_workflow_response
         }
         self.conversation_ids = {}
-
-    async def make_payloads(self, text: str, image_bytes: bytes = None, inputs: dict = None) -> Dict:
-        payloads = {
+        # リクエストごとに組み立てないよう、URLとヘッダーは事前に用意しておく
+        self._chat_url = f"{base_url}/chat-messages"
+        self._upload_url = f"{base_url}/files/upload"
+        self._auth_headers = {"Authorization": f"Bearer {api_key}"}
+        self._json_headers = {"Content-Type": "application/json", **self._auth_headers}
+        # 複数のエージェントで接続プールを共有する場合は、共有のClientSessionを返す関数を受け取る
+        self._session_provider = session_provider
+        # 共有しない場合、ClientSessionは初回利用時に生成して保持する
+        self._session: aiohttp.ClientSession = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session_provider is not None:
+            return self._session_provider()
+        if self._session is None or self._session.closed:
+            self._session = create_client_session()
+        return self._session
+
+    async def close(self):
+        # 共有のClientSessionは所有者（生成した側）が閉じる
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def make_text_payloads(self, text: str, inputs: dict = None) -> Dict:
+        return {
             "inputs": inputs or {},
             "query": text or "",
-            "response_mode": "streaming" if self.type == DifyType.Agent else "blocking",
+            "response_mode": self._response_mode,
             "user": self.user,
             "auto_generate_name": False,
         }
 
+    def attach_image(self, payloads: Dict, uploaded_image_id: str) -> Dict:
+        if uploaded_image_id:
+            payloads["files"] = [{
+                "type": "image",
+                "transfer_method": "local_file",
+                "upload_file_id": uploaded_image_id
+            }]
+            if not payloads["query"]:
+                payloads["query"] = "."  # queryが空の場合、ダミーのテキストを設定
+        return payloads
+
+    async def make_payloads(self, text: str, image_bytes: bytes = None, inputs: dict = None) -> Dict:
+        payloads = self.make_text_payloads(text, inputs)
+
         if image_bytes:
-            uploaded_image_id = await self.upload_image(image_bytes)
-            if uploaded_image_id:
-                payloads["files"] = [{
-                    "type": "image",
-                    "transfer_method": "local_file",
-                    "upload_file_id": uploaded_image_id
-                }]
-                if not payloads["query"]:
-                    payloads["query"] = "."  # queryが空の場合、ダミーのテキストを設定
+            self.attach_image(payloads, await self.upload_image(image_bytes))
 
         return payloads
 
@@ -65,40 +108,53 @@ class DifyAgent:
         )
         form_data.add_field('user', self.user)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.base_url + "/files/upload",
-                headers={"Authorization": f"Bearer {self.api_key}"},
-                data=form_data
-            ) as response:
-                response_json = await response.json()
-                if self.verbose:
-                    logger.info(f"File upload response: {json.dumps(response_json, ensure_ascii=False)}")
-                response.raise_for_status()
-                return response_json["id"]
+        async with self.get_session().post(
+            self._upload_url,
+            headers=self._auth_headers,
+            data=form_data
+        ) as response:
+            response_json = await response.json(loads=orjson.loads)
+            if self.verbose and logger.isEnabledFor(INFO):
+                logger.info("File upload response: %s", orjson.dumps(response_json).decode())
+            response.raise_for_status()
+            return response_json["id"]
+
+    async def iter_sse_frames(self, response: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        # SSEのイベント（フレーム）は空行区切り。受信データの区切りはフレームの境界と一致しないため、
+        # 途中までのフレームはバッファに残して次の受信データと連結する
+        buffer = b""
+        async for data in response.content.iter_any():
+            # 改行コードはCRLFも許容されるためLFに揃える。受信データの末尾の\rはバッファに残るため、
+            # 次の受信データ先頭の\nと連結してから置換される
+            buffer = (buffer + data).replace(b"\r\n", b"\n")
+            *frames, buffer = buffer.split(b"\n\n")
+            for frame in frames:
+                yield frame
+        if buffer:
+            yield buffer
 
     async def process_agent_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
         conversation_id = ""
-        response_text = ""
+        response_texts = []
         response_data = {}
 
-        async for line in response.content:
-            decoded_line = line.decode("utf-8").strip()
-            if not decoded_line.startswith("data:"):
+        async for frame in self.iter_sse_frames(response):
+            # デコードはdata行のJSON部分だけに限定する。複数のdata行は改行で連結する（SSE仕様）
+            payload = b"\n".join([line[5:].strip() for line in frame.split(b"\n") if line.startswith(b"data:")])
+            if not payload:
                 continue
-            json_str = decoded_line[5:].strip()
-            if json_str == "[DONE]":
+            if payload == b"[DONE]":
                 break
-            chunk = json.loads(json_str)
+            chunk = orjson.loads(payload)
 
-            if self.verbose:
-                logger.debug(f"Chunk from Dify: {json.dumps(chunk, ensure_ascii=False)}")
+            if self.verbose and logger.isEnabledFor(DEBUG):
+                logger.debug("Chunk from Dify: %s", orjson.dumps(chunk).decode())
 
             event_type = chunk.get("event")
 
             if event_type == "message":
                 # メッセージのテキストを蓄積
-                response_text += chunk.get("answer", "")
+                response_texts.append(chunk.get("answer", ""))
                 # conversation_idを取得
                 conversation_id = chunk.get("conversation_id", conversation_id)
 
@@ -115,13 +171,13 @@ class DifyAgent:
             # 他のイベントタイプも必要に応じて処理
             # 例: "message_replace", "tts_message", "tts_message_end"など
 
-        return conversation_id, response_text, response_data
+        return conversation_id, "".join(response_texts), response_data
 
     async def process_chatbot_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        response_json = await response.json()
+        response_json = await response.json(loads=orjson.loads)
 
-        if self.verbose:
-            logger.info(f"Response from Dify: {json.dumps(response_json, ensure_ascii=False)}")
+        if self.verbose and logger.isEnabledFor(INFO):
+            logger.info("Response from Dify: %s", orjson.dumps(response_json).decode())
 
         conversation_id = response_json.get("conversation_id", "")
         response_text = response_json.get("answer", "")
@@ -131,43 +187,40 @@ class DifyAgent:
         return conversation_id, response_text, response_data
 
     async def process_textgenerator_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        if self.verbose:
-            logger.info(f"Response from Dify: {json.dumps(await response.json(), ensure_ascii=False)}")
+        if self.verbose and logger.isEnabledFor(INFO):
+            logger.info("Response from Dify: %s", await response.text())
 
-        raise Exception("TextGenerator is not supported for now.")
+        raise NotImplementedError("TextGenerator is not supported for now.")
 
     async def process_workflow_response(self, response: aiohttp.ClientResponse) -> Tuple[str, str, Dict]:
-        if self.verbose:
-            logger.info(f"Response from Dify: {json.dumps(await response.json(), ensure_ascii=False)}")
+        if self.verbose and logger.isEnabledFor(INFO):
+            logger.info("Response from Dify: %s", await response.text())
 
-        raise Exception("Workflow is not supported for now.")
+        raise NotImplementedError("Workflow is not supported for now.")
 
     async def invoke(self, conversation_id: str, text: str = None, image: bytes = None, inputs: dict = None, start_as_new: bool = False) -> Tuple[str, str, Dict]:
-        headers = {
-            "Authorization": f"Bearer {self.api_key}"
-        }
-
-        payloads = await self.make_payloads(text, image, inputs)
+        # 画像がない場合（大半のテキストメッセージ）はアップロード処理を経由せずに組み立てる
+        # 画像がある場合、チャットのリクエストにはアップロードしたファイルIDが必要なため、アップロードの完了を待つ
+        payloads = await self.make_payloads(text, image, inputs) if image else self.make_text_payloads(text, inputs)
 
         if conversation_id and not start_as_new:
             payloads["conversation_id"] = conversation_id
 
-        async with aiohttp.ClientSession() as session:
-            if self.verbose:
-                logger.info(f"Request to Dify: {json.dumps(payloads, ensure_ascii=False)}")
+        if self.verbose and logger.isEnabledFor(INFO):
+            logger.info("Request to Dify: %s", orjson.dumps(payloads).decode())
 
-            async with session.post(
-                self.base_url + "/chat-messages",
-                headers=headers,
-                json=payloads
-            ) as response:
+        async with self.get_session().post(
+            self._chat_url,
+            headers=self._json_headers,
+            data=orjson.dumps(payloads)
+        ) as response:
 
-                if response.status != 200:
-                    error_response = await response.json()
-                    logger.error(f"Error response from Dify: {json.dumps(error_response, ensure_ascii=False)}")
-                    response.raise_for_status()
+            if response.status != 200:
+                error_response = await response.json(loads=orjson.loads)
+                logger.error(f"Error response from Dify: {orjson.dumps(error_response).decode()}")
+                response.raise_for_status()
 
-                response_processor = self.response_processors[self.type]
-                conversation_id, response_text, response_data = await response_processor(response)
+            response_processor = self.response_processors[self.type]
+            conversation_id, response_text, response_data = await response_processor(response)
 
-                return conversation_id, response_text, response_data
+        return conversation_id, response_text, response_data
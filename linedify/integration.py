@@ -1,11 +1,20 @@
 # linedify/integration.py
 
-import json
-from logging import getLogger, NullHandler
-from traceback import format_exc
+import asyncio
+import base64
+import hashlib
+import hmac
+from logging import getLogger, NullHandler, INFO
+from traceback import format_exc, format_exception
 from typing import Dict, List, Tuple, Union
 
+import aiohttp
+from cachetools import TTLCache
+import orjson
+
 from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.models.events import UnknownEvent
 from linebot.v3.messaging import (
     Configuration,
     AsyncApiClient,
@@ -24,12 +33,20 @@ from linebot.v3.webhooks import (
     ImageMessageContent
 )
 
-from .dify import DifyAgent, DifyType
+from .dify import DifyAgent, DifyType, create_client_session
 from .session import ConversationSession, ConversationSessionStore
 
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
+# 固定のエラー応答メッセージは起動時に一度だけ生成する
+DEFAULT_ERROR_MESSAGE = TextMessage(text="申し訳ありませんが、エラーが発生しました。しばらくしてからもう一度お試しください。")
+
+class UnhandledMessageType(Exception):
+    def __init__(self, message_type: str) -> None:
+        super().__init__(f"Unhandled message type: {message_type}")
+        self.message_type = message_type
+
 class LineDifyIntegrator:
     def __init__(self, *,
                  line_channel_access_token: str,
@@ -38,11 +55,27 @@ class LineDifyIntegrator:
                  dify_type: DifyType = DifyType.Agent,
                  session_db_url: str = "sqlite:///sessions.db",
                  session_timeout: float = 3600.0,
+                 session_cache_size: int = 0,
+                 event_dedup_size: int = 20000,
+                 event_dedup_ttl: float = 600.0,
                  verbose: bool = False) -> None:
 
         self.verbose = verbose
         self.dify_type = dify_type
         self.dify_agents = dify_agents  # Difyエージェント情報を保持
+        # Difyへの接続プールは全エージェントで共有する（初回利用時に生成）
+        self._http_session: aiohttp.ClientSession = None
+        # DifyAgentはエージェントキーごとに一度だけ生成し、HTTP接続とともに使い回す
+        self._agents: Dict[str, DifyAgent] = {
+            k: DifyAgent(
+                api_key=v["api_key"],
+                base_url=v["base_url"],
+                user=v["user"],
+                type=dify_type,
+                session_provider=self.get_http_session,
+                verbose=verbose
+            ) for k, v in dify_agents.items()
+        }
 
         # LINE API の設定
         line_api_configuration = Configuration(
@@ -51,6 +84,8 @@ class LineDifyIntegrator:
         self.line_api_client = AsyncApiClient(line_api_configuration)
         self.line_api = AsyncMessagingApi(self.line_api_client)
         self.line_api_blob = AsyncMessagingApiBlob(self.line_api_client)
+        self.line_channel_secret = line_channel_secret.encode("utf-8")
+        # 公開属性として残す（リクエスト処理自体は verify_signature と parse_events を使う）
         self.webhook_parser = WebhookParser(line_channel_secret)
 
         # イベントハンドラとメッセージパーサーの初期化
@@ -69,9 +104,13 @@ class LineDifyIntegrator:
         # セッションストアの初期化
         self.conversation_session_store = ConversationSessionStore(
             db_url=session_db_url,
-            timeout=session_timeout
+            timeout=session_timeout,
+            cache_size=session_cache_size
         )
 
+        # 再送されたWebhookイベントでDifyを再度呼び出さないよう、受信済みのイベントIDを保持する。sizeが0の場合は無効
+        self.processed_event_ids = TTLCache(maxsize=event_dedup_size, ttl=event_dedup_ttl) if event_dedup_size > 0 else None
+
         # カスタム関数の初期化
         self._make_inputs = self.make_inputs_default
         self._to_reply_message = self.to_reply_message_default
@@ -115,8 +154,68 @@ class LineDifyIntegrator:
         return None
 
     # リクエスト処理
-    async def process_request(self, request_body: str, signature: str):
-        events = self.webhook_parser.parse(request_body, signature)
+    def verify_signature(self, request_body: bytes, signature: str) -> bool:
+        expected_signature = base64.b64encode(hmac.new(self.line_channel_secret, request_body, hashlib.sha256).digest())
+        return hmac.compare_digest(expected_signature, signature.encode("utf-8"))
+
+    def parse_events(self, request_body: bytes) -> List[Event]:
+        body = orjson.loads(request_body)
+        # 署名が正しくても形式が不正なボディはValueErrorとして扱う
+        if not isinstance(body, dict) or not isinstance(body.get("events"), list) \
+                or not all(isinstance(event, dict) for event in body["events"]):
+            raise ValueError("Invalid webhook request body")
+
+        events = []
+        for event in body["events"]:
+            try:
+                events.append(Event.from_dict(event))
+            except ValueError:
+                logger.info("Unknown event type: %s", event["type"])
+                events.append(UnknownEvent.new_from_json_dict(event))
+        return events
+
+    async def process_request(self, request_body: Union[str, bytes], signature: str, verified: bool = False):
+        if isinstance(request_body, str):
+            request_body = request_body.encode("utf-8")
+
+        # 署名検証はJSONのパースより先に、リクエストボディのバイト列のまま行う
+        # 受信時に検証済みの場合（verified=True）は省略する
+        if not verified and not self.verify_signature(request_body, signature):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+        await self.process_events(self.parse_events(request_body))
+
+    def is_duplicate_event(self, event: Event) -> bool:
+        if self.processed_event_ids is None:
+            return False
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return False
+        if event_id in self.processed_event_ids:
+            return True
+        # 処理の開始時点で記録し、処理中に届いた再送も除外する
+        self.processed_event_ids[event_id] = True
+        return False
+
+    async def process_events(self, events: List[Event]):
+        # 同じユーザーのイベントは順番に、異なるユーザーのイベントは並行して処理する
+        events_by_user: Dict[str, List[Event]] = {}
+        for event in events:
+            if self.is_duplicate_event(event):
+                logger.info("Skip duplicate event: %s", event.webhook_event_id)
+                continue
+            user_id = getattr(event.source, "user_id", None) or id(event)
+            events_by_user.setdefault(user_id, []).append(event)
+
+        results = await asyncio.gather(
+            *(self.process_user_events(user_events) for user_events in events_by_user.values()),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error at processing events: {result}\n{''.join(format_exception(result))}")
+
+    async def process_user_events(self, events: List[Event]):
         for event in events:
             reply_messages = await self.process_event(event)
 
@@ -152,12 +251,12 @@ class LineDifyIntegrator:
     async def handle_message_event(self, event: MessageEvent):
         conversation_session = None
         try:
-            if self.verbose:
-                logger.info(f"Request from LINE: {json.dumps(event.as_json_dict(), ensure_ascii=False)}")
+            if self.verbose and logger.isEnabledFor(INFO):
+                logger.info("Request from LINE: %s", orjson.dumps(event.to_dict()).decode())
 
             parse_message = self._message_parsers.get(event.message.type)
             if not parse_message:
-                raise Exception(f"Unhandled message type: {event.message.type}")
+                raise UnhandledMessageType(event.message.type)
 
             request_text, image_bytes = await parse_message(event.message)
             user_id = event.source.user_id
@@ -169,16 +268,7 @@ class LineDifyIntegrator:
 
             # セッションからエージェントキーを取得し、Difyエージェント情報を取得
             agent_key = conversation_session.agent_key or "default"
-            agent_info = self.dify_agents.get(agent_key, self.dify_agents["default"])
-
-            # DifyAgentを生成
-            dify_agent = DifyAgent(
-                api_key=agent_info["api_key"],
-                base_url=agent_info["base_url"],
-                user=agent_info["user"],
-                type=self.dify_type,
-                verbose=self.verbose
-            )
+            dify_agent = self.get_agent(agent_key)
 
             # DifyAgentを使用して会話を進行
             conversation_id, text, data = await dify_agent.invoke(
@@ -195,15 +285,28 @@ class LineDifyIntegrator:
             # 応答メッセージを生成
             response_messages = await self._to_reply_message(text, data, conversation_session)
 
-            if self.verbose:
-                logger.info(f"Response to LINE: {', '.join([json.dumps(m.as_json_dict(), ensure_ascii=False) for m in response_messages])}")
+            if self.verbose and response_messages and logger.isEnabledFor(INFO):
+                logger.info("Response to LINE: %s", orjson.dumps([m.to_dict() for m in response_messages]).decode())
 
             return response_messages
 
+        except UnhandledMessageType as umt:
+            # 想定内のケースのためスタックトレースは出力しない
+            logger.warning(str(umt))
+            return await self._to_error_message(event, umt, conversation_session)
+
         except Exception as e:
             logger.error(f"Error in processing message event: {e}\n{format_exc()}")
             return await self._to_error_message(event, e, conversation_session)
 
+    def get_http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = create_client_session(limit=200)  # 全エージェント分の同時接続数
+        return self._http_session
+
+    def get_agent(self, agent_key: str) -> DifyAgent:
+        return self._agents.get(agent_key) or self._agents["default"]
+
     # デフォルトのメッセージパーサー
     async def parse_text_message(self, message: TextMessageContent):
         return message.text, None
@@ -239,8 +342,13 @@ class LineDifyIntegrator:
 
     # デフォルトの to_error_message 関数
     async def to_error_message_default(self, event: Event, ex: Exception, session: ConversationSession = None):
-        text = "申し訳ありませんが、エラーが発生しました。しばらくしてからもう一度お試しください。"
-        return [TextMessage(text=text)]
+        return [DEFAULT_ERROR_MESSAGE]
 
     async def shutdown(self):
+        for dify_agent in self._agents.values():
+            await dify_agent.close()
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+        await self.line_api_client.close()
         await self.conversation_session_store.close()
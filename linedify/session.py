@@ -1,9 +1,19 @@
+import asyncio
+from contextlib import nullcontext
 from datetime import datetime, timezone
+import threading
 from typing import List
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, UniqueConstraint
+from cachetools import LRUCache
+from sqlalchemy import create_engine, make_url, select, Column, String, DateTime, Boolean, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 class ConversationSession:
+    # メモリ上に多数キャッシュされるため、__dict__を持たせずにメモリ使用量と属性アクセスのコストを抑える
+    __slots__ = ("user_id", "conversation_id", "_updated_at", "_updated_at_iso", "agent_key", "state")
+
     def __init__(self, user_id: str, conversation_id: str = None, updated_at: datetime = None, agent_key: str = "default", state: str = None) -> None:
         self.user_id = user_id
         self.conversation_id = conversation_id
@@ -11,21 +21,48 @@ class ConversationSession:
         self.agent_key = agent_key
         self.state = state
 
+    @property
+    def updated_at(self) -> datetime:
+        return self._updated_at
+
+    @updated_at.setter
+    def updated_at(self, value: datetime) -> None:
+        self._updated_at = value
+        self._updated_at_iso = None  # 更新されたらISO形式の文字列を作り直す
+
+    @property
+    def updated_at_iso(self) -> str:
+        if self._updated_at_iso is None:
+            self._updated_at_iso = self._updated_at.isoformat()
+        return self._updated_at_iso
+
+    def copy(self) -> "ConversationSession":
+        return ConversationSession(
+            user_id=self.user_id,
+            conversation_id=self.conversation_id,
+            updated_at=self.updated_at,
+            agent_key=self.agent_key,
+            state=self.state
+        )
+
     def to_dict(self):
         return {
             "user_id": self.user_id,
             "conversation_id": self.conversation_id,
-            "updated_at": self.updated_at.isoformat(),
+            "updated_at": self.updated_at_iso,
             "agent_key": self.agent_key,
             "state": self.state
         }
 
     @staticmethod
     def from_dict(data):
+        updated_at = data["updated_at"]
+        if isinstance(updated_at, str):
+            updated_at = datetime.fromisoformat(updated_at)
         return ConversationSession(
             user_id=data["user_id"],
             conversation_id=data.get("conversation_id"),
-            updated_at=datetime.fromisoformat(data["updated_at"]),
+            updated_at=updated_at,
             agent_key=data.get("agent_key", "default"),
             state=data.get("state")
         )
@@ -45,38 +82,82 @@ class ConversationSessionModel(Base):
 
     __table_args__ = (UniqueConstraint("user_id", name="uix_user"),)
 
+# INSERT ... ON CONFLICT DO UPDATE に対応しているDBのinsert
+upsert_inserts = {
+    "sqlite": sqlite_insert,
+    "postgresql": postgresql_insert
+}
+
 class ConversationSessionStore:
-    def __init__(self, db_url: str = "sqlite:///sessions.db", timeout: float = 3600.0) -> None:
+    def __init__(self, db_url: str = "sqlite:///sessions.db", timeout: float = 3600.0, cache_size: int = 0) -> None:
         self.timeout = timeout
-        self.engine = create_engine(db_url)
+        # 直近のセッションをメモリに保持してDBの読み込みを省略する（書き込みはDBにも反映）。sizeが0の場合は無効
+        # 複数プロセスで同じDBを共有する場合は他プロセスの更新が反映されないため、有効にしないこと
+        self.cache = LRUCache(maxsize=cache_size) if cache_size > 0 else None
+        url = make_url(db_url)
+        if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+            # インメモリのSQLiteはスレッドごとに別DBとなるため、単一の接続を共有する
+            self.engine = create_engine(url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+            # 単一の接続を複数のスレッドから同時に使うとトランザクションが混ざるため、DBアクセスを直列化する
+            self._db_lock = threading.Lock()
+        else:
+            self.engine = create_engine(url, pool_size=10, pool_pre_ping=True)
+            self._db_lock = nullcontext()
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
+        self.upsert_insert = upsert_inserts.get(self.engine.dialect.name)
+
+    async def run_in_thread(self, func, *args):
+        # DBアクセスはブロッキングするため、イベントループを止めないようスレッドで実行
+        return await asyncio.to_thread(self._run_locked, func, *args)
+
+    def _run_locked(self, func, *args):
+        with self._db_lock:
+            return func(*args)
 
     async def get_session(self, user_id: str) -> ConversationSession:
         if not user_id:
             raise Exception("user_id is required")
 
-        with self.Session() as session:
-            db_session = session.query(ConversationSessionModel).filter_by(user_id=user_id).first()
+        if self.cache is not None:
+            if cached_session := self.cache.get(user_id):
+                if self.is_timeout(cached_session.updated_at):
+                    return ConversationSession(user_id)
+                return cached_session.copy()
 
-            now = datetime.now(timezone.utc)
+        row = await self.run_in_thread(self._select_session, user_id)
 
-            if db_session is None:
-                return ConversationSession(user_id)
+        if row is None:
+            return ConversationSession(user_id)
 
-            if db_session.is_expired:
-                return ConversationSession(user_id)
+        if row.is_expired:
+            return ConversationSession(user_id)
 
-            if self.timeout > 0 and (now - db_session.updated_at.replace(tzinfo=timezone.utc)).total_seconds() > self.timeout:
-                return ConversationSession(user_id)
+        updated_at = row.updated_at.replace(tzinfo=timezone.utc)
+        if self.is_timeout(updated_at):
+            return ConversationSession(user_id)
 
-            return ConversationSession(
-                user_id=db_session.user_id,
-                conversation_id=db_session.conversation_id,
-                updated_at=db_session.updated_at.replace(tzinfo=timezone.utc),
-                agent_key=db_session.agent_key,
-                state=db_session.state
-            )
+        conversation_session = ConversationSession(
+            user_id=row.user_id,
+            conversation_id=row.conversation_id,
+            updated_at=updated_at,
+            agent_key=row.agent_key,
+            state=row.state
+        )
+        if self.cache is not None:
+            self.cache[user_id] = conversation_session.copy()
+        return conversation_session
+
+    def _select_session(self, user_id: str):
+        M = ConversationSessionModel
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(M.user_id, M.conversation_id, M.updated_at, M.is_expired, M.agent_key, M.state)
+                    .where(M.user_id == user_id)
+            ).first()
+
+    def is_timeout(self, updated_at: datetime) -> bool:
+        return self.timeout > 0 and (datetime.now(timezone.utc) - updated_at).total_seconds() > self.timeout
 
     async def set_session(self, session_data: ConversationSession) -> None:
         if not session_data.user_id:
@@ -84,24 +165,45 @@ class ConversationSessionStore:
 
         session_data.updated_at = datetime.now(timezone.utc)
 
-        with self.Session() as db_session:
-            db_session_model = db_session.query(ConversationSessionModel).filter_by(user_id=session_data.user_id).first()
-            if db_session_model is None:
-                db_session_model = ConversationSessionModel(
-                    id=session_data.user_id,
-                    user_id=session_data.user_id
-                )
-            db_session_model.conversation_id = session_data.conversation_id
-            db_session_model.updated_at = session_data.updated_at
-            db_session_model.agent_key = session_data.agent_key
-            db_session_model.state = session_data.state
-            db_session.merge(db_session_model)
-            db_session.commit()
+        if self.cache is not None:
+            self.cache[session_data.user_id] = session_data.copy()
+
+        values = {
+            "conversation_id": session_data.conversation_id,
+            "updated_at": session_data.updated_at,
+            "agent_key": session_data.agent_key,
+            "state": session_data.state,
+            "is_expired": False
+        }
+        await self.run_in_thread(self._upsert_session, session_data.user_id, values)
+
+    def _upsert_session(self, user_id: str, values: dict) -> None:
+        if self.upsert_insert is None:
+            # ON CONFLICTに対応していないDBはORMのmergeで更新
+            with self.Session() as db_session:
+                db_session.merge(ConversationSessionModel(id=user_id, user_id=user_id, **values))
+                db_session.commit()
+            return
+
+        stmt = self.upsert_insert(ConversationSessionModel.__table__).values(
+            id=user_id,
+            user_id=user_id,
+            **values
+        ).on_conflict_do_update(index_elements=["user_id"], set_=values)
+
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
 
     async def expire_session(self, user_id: str) -> None:
         if not user_id:
             raise Exception("user_id is required")
 
+        if self.cache is not None:
+            self.cache.pop(user_id, None)
+
+        await self.run_in_thread(self._expire_session, user_id)
+
+    def _expire_session(self, user_id: str) -> None:
         with self.Session() as session:
             db_session = session.query(ConversationSessionModel).filter_by(user_id=user_id).first()
 
@@ -110,14 +212,28 @@ class ConversationSessionStore:
                 session.commit()
 
     async def get_user_conversations(self, user_id: str, count: int = 20) -> List[ConversationSession]:
-        with self.Session() as session:
-            db_sessions = session.query(ConversationSessionModel).filter_by(user_id=user_id).order_by(ConversationSessionModel.updated_at.desc()).limit(count)
-            user_conversations = [ConversationSession(
-                user_id=db_session.user_id,
-                conversation_id=db_session.conversation_id,
-                updated_at=db_session.updated_at.replace(tzinfo=timezone.utc),
-                agent_key=db_session.agent_key,
-                state=db_session.state
-            ) for db_session in db_sessions]
-            user_conversations.reverse()
-            return user_conversations
+        return await self.run_in_thread(self._get_user_conversations, user_id, count)
+
+    def _get_user_conversations(self, user_id: str, count: int) -> List[ConversationSession]:
+        M = ConversationSessionModel
+        # 新しい順にcount件取得したものを、SQL側で古い順に並べ替える
+        latest = (
+            select(M.user_id, M.conversation_id, M.updated_at, M.agent_key, M.state)
+                .where(M.user_id == user_id)
+                .order_by(M.updated_at.desc())
+                .limit(count)
+                .subquery()
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(latest).order_by(latest.c.updated_at.asc())).all()
+
+        return [ConversationSession(
+            user_id=row.user_id,
+            conversation_id=row.conversation_id,
+            updated_at=row.updated_at.replace(tzinfo=timezone.utc),
+            agent_key=row.agent_key,
+            state=row.state
+        ) for row in rows]
+
+    async def close(self) -> None:
+        await self.run_in_thread(self.engine.dispose)
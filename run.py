@@ -1,8 +1,11 @@
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, BackgroundTasks
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from linedify import LineDify
-from linedify.dify import DifyAgent, DifyType  # DifyAgentをインポート
+from linedify.dify import DifyType
 from linebot.v3.messaging import (
+    Message,
     TextMessage,
     ReplyMessageRequest,
     QuickReply,
@@ -15,12 +18,33 @@ from linebot.v3.webhooks import (
     Event
 )
 from linedify.session import ConversationSession
+import logging
 import os
+import re
+from typing import Optional, Tuple
 
 
 # 環境変数から値を取得
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+# このモジュールのログ設定（linedifyのロガーは linedify/__init__.py で設定済みのため触らない）
+# ログレベルは環境変数で指定する（デバッグログは無効時にフォーマットされない）
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s : %(message)s"))
+logger.addHandler(log_handler)
+logger.propagate = False
+
+# Webhookを並行して処理するワーカー数（1件のWebhook内の複数ユーザーのイベントはさらに並行して処理される）
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '10'))
+# 未処理のWebhookを保持する上限。超えた場合は503を返してLINEに再送させる
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# uvicornのワーカー（プロセス）数。uvicorn自体もこの環境変数を既定値として使う
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+# セッションのメモリキャッシュはプロセスごとのため、シングルプロセスの場合のみ有効にする
+SESSION_CACHE_SIZE = 4096 if WEB_CONCURRENCY == 1 else 0
 
 # Dify エージェント情報を辞書にまとめる（sender画像も含む）
 DIFY_AGENTS = {
@@ -41,6 +65,25 @@ DIFY_AGENTS = {
 
 # 利用可能なタイプのリスト
 AVAILABLE_TYPES = list(DIFY_AGENTS.keys())
+# メンバー判定用（順序が必要な場合はリストを使う）
+AVAILABLE_TYPES_SET = frozenset(DIFY_AGENTS)
+
+# 応答メッセージのsender情報（エージェント情報は起動後に変わらないため一度だけ生成）
+SENDER_BY_AGENT = {
+    agent_key: {"name": agent_key, "iconUrl": agent_info.get("iconUrl")}
+    for agent_key, agent_info in DIFY_AGENTS.items()
+}
+
+# エージェント切替のキーワード（1回の走査ですべてのキーワードを検出する）
+SWITCH_KEYWORDS_RE = re.compile("フィナ|バイバイ")
+
+# エージェント切替時の応答メッセージ（内容は固定のため起動時に一度だけ生成）
+SWITCH_MESSAGES = {
+    agent_key: TextMessage(
+        text=f"エージェントを{agent_key}に切り替えました。",
+        sender=SENDER_BY_AGENT[agent_key]
+    ) for agent_key in DIFY_AGENTS
+}
 
 # LineDify のインスタンスを作成
 line_dify = LineDify(
@@ -48,16 +91,57 @@ line_dify = LineDify(
     line_channel_secret=LINE_CHANNEL_SECRET,
     dify_agents=DIFY_AGENTS,  # ここを追加
     dify_type=DifyType.Chatbot,
+    session_cache_size=SESSION_CACHE_SIZE,
     verbose=True
 )
 
+# 返信リクエストの組み立てを一箇所にまとめる
+async def reply(reply_token: str, *messages: Message):
+    await line_dify.line_api.reply_message(
+        ReplyMessageRequest(replyToken=reply_token, messages=list(messages))
+    )
+
+# 返信とセッションの保存は互いに独立しているため並行して行う
+# どちらかが失敗しても両方の完了を待ち、（返信の例外, 保存できたかどうか）を返す
+async def reply_and_save(reply_token: str, session: ConversationSession, *messages: Message) -> Tuple[Optional[BaseException], bool]:
+    reply_result, save_result = await asyncio.gather(
+        reply(reply_token, *messages),
+        line_dify.conversation_session_store.set_session(session),
+        return_exceptions=True
+    )
+    if isinstance(save_result, BaseException):
+        logger.warning("セッションの保存に失敗しました: %s", save_result)
+    return (reply_result if isinstance(reply_result, BaseException) else None), not isinstance(save_result, BaseException)
+
+# Webhookのイベントをキューから取り出して処理するワーカー
+async def webhook_worker(queue: asyncio.Queue):
+    while True:
+        events = await queue.get()
+        try:
+            await line_dify.process_events(events)
+        except Exception:
+            logger.exception("Webhookイベントの処理に失敗しました")
+        finally:
+            queue.task_done()
+
 # FastAPI のアプリケーションを作成
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Webhookの受信とイベント処理（Dify呼び出し）を切り離し、固定数のワーカーで処理する
+    app.state.webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workers = [asyncio.create_task(webhook_worker(app.state.webhook_queue)) for _ in range(WEBHOOK_WORKERS)]
+
     yield
+
+    # 受信済みのイベントを処理し終えてから停止する
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(app.state.webhook_queue.join(), timeout=30)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
     await line_dify.shutdown()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # @line_dify.validate_event を使用して、イベントの処理前にユーザーのエージェント情報を取得
 @line_dify.validate_event
@@ -73,95 +157,81 @@ async def handle_message_event(event: MessageEvent):
 
     # ユーザーのセッションを取得
     conversation_session = await line_dify.conversation_session_store.get_session(user_id)
+    # 未保存の変更があるかどうか（返信と同時に保存できた後はFalseに戻す）
+    dirty = False
 
-    # セッション内の agent_key が None, 空文字, または "default" の場合は "Emily" に設定
-    if conversation_session.agent_key in (None, "", "default"):
-        conversation_session.agent_key = "Emily"
-        await line_dify.conversation_session_store.set_session(conversation_session)
-
-    if isinstance(message, TextMessageContent):
-        text = message.text.strip()
-
-        # デバッグログ
-        print("DEBUG: 受信メッセージ:", text)
-        print("DEBUG: 現在のエージェント:", conversation_session.agent_key)
-
-        # 条件1: 「フィナ」が含まれており、「バイバイ」が含まれていない場合、かつ現在のエージェントが "Emily" の場合
-        if "フィナ" in text and "バイバイ" not in text:
-            if conversation_session.agent_key == "Emily":
-                conversation_session.agent_key = "フィナ"
-                conversation_session.conversation_id = None  # 新規会話開始
-                reply_msg = TextMessage(
-                    text="エージェントをフィナに切り替えました。",
-                    sender={"name": "フィナ", "iconUrl": DIFY_AGENTS["フィナ"]["iconUrl"]}
-                )
-                await line_dify.line_api.reply_message(
-                    ReplyMessageRequest(
-                        replyToken=event.reply_token,
-                        messages=[reply_msg]
-                    )
-                )
-                await line_dify.conversation_session_store.set_session(conversation_session)
-                print("DEBUG: エージェント切替実行：Emily -> フィナ")
-                return []
-
-        # 条件2: 「フィナ」と「バイバイ」の両方が含まれている場合、かつ現在のエージェントが "フィナ" の場合
-        elif "フィナ" in text and "バイバイ" in text:
-            if conversation_session.agent_key == "フィナ":
-                conversation_session.agent_key = "Emily"
-                conversation_session.conversation_id = None  # 新規会話開始
-                reply_msg = TextMessage(
-                    text="エージェントをEmilyに切り替えました。",
-                    sender={"name": "Emily", "iconUrl": DIFY_AGENTS["Emily"]["iconUrl"]}
-                )
-                await line_dify.line_api.reply_message(
-                    ReplyMessageRequest(
-                        replyToken=event.reply_token,
-                        messages=[reply_msg]
-                    )
-                )
-                await line_dify.conversation_session_store.set_session(conversation_session)
-                print("DEBUG: エージェント切替実行：フィナ -> Emily")
-                return []
-
-    # 通常のメッセージ処理を行う
-    # ユーザーのエージェントキーに基づいてDifyエージェントを取得
-    agent_key = conversation_session.agent_key or "Emily"
-    agent_info = DIFY_AGENTS.get(agent_key, DIFY_AGENTS["Emily"])
-
-    # DifyAgentを生成
-    dify_agent = DifyAgent(
-        api_key=agent_info["api_key"],
-        base_url=agent_info["base_url"],
-        user=agent_info["user"],
-        type=DifyType.Chatbot,
-        verbose=True
-    )
+    try:
+        # セッション内の agent_key が未設定（None, 空文字, "default"）または設定にないエージェントの場合は "Emily" に設定
+        if conversation_session.agent_key not in AVAILABLE_TYPES_SET:
+            conversation_session.agent_key = "Emily"
+            dirty = True
 
-    # DifyAgentを使用して会話を進行
-    conversation_id, response_text, data = await dify_agent.invoke(
-        conversation_session.conversation_id,
-        text=message.text,
-        inputs={}
-    )
+        if isinstance(message, TextMessageContent):
+            text = message.text.strip()
+            keywords = set(SWITCH_KEYWORDS_RE.findall(text))
 
-    # セッション情報を更新
-    conversation_session.conversation_id = conversation_id
-    await line_dify.conversation_session_store.set_session(conversation_session)
+            # デバッグログ
+            logger.debug("受信メッセージ: %s", text)
+            logger.debug("現在のエージェント: %s", conversation_session.agent_key)
 
-    # 応答メッセージを生成（sender情報を含める）
-    reply_message = TextMessage(
-        text=response_text,
-        sender={"name": agent_key, "iconUrl": agent_info.get("iconUrl")}
-    )
-    await line_dify.line_api.reply_message(
-        ReplyMessageRequest(
-            replyToken=event.reply_token,
-            messages=[reply_message]
+            # 条件1: 「フィナ」が含まれており、「バイバイ」が含まれていない場合、かつ現在のエージェントが "Emily" の場合
+            if "フィナ" in keywords and "バイバイ" not in keywords:
+                if conversation_session.agent_key == "Emily":
+                    conversation_session.agent_key = "フィナ"
+                    conversation_session.conversation_id = None  # 新規会話開始
+                    reply_error, saved = await reply_and_save(event.reply_token, conversation_session, SWITCH_MESSAGES["フィナ"])
+                    dirty = not saved
+                    if reply_error:
+                        raise reply_error
+                    logger.debug("エージェント切替実行：Emily -> フィナ")
+                    return []
+
+            # 条件2: 「フィナ」と「バイバイ」の両方が含まれている場合、かつ現在のエージェントが "フィナ" の場合
+            elif "フィナ" in keywords and "バイバイ" in keywords:
+                if conversation_session.agent_key == "フィナ":
+                    conversation_session.agent_key = "Emily"
+                    conversation_session.conversation_id = None  # 新規会話開始
+                    reply_error, saved = await reply_and_save(event.reply_token, conversation_session, SWITCH_MESSAGES["Emily"])
+                    dirty = not saved
+                    if reply_error:
+                        raise reply_error
+                    logger.debug("エージェント切替実行：フィナ -> Emily")
+                    return []
+
+        # 通常のメッセージ処理を行う
+        # ユーザーのエージェントキーに基づいてDifyエージェントを取得
+        # agent_keyは冒頭で設定済みのエージェントに正規化している
+        agent_key = conversation_session.agent_key
+
+        # LineDifyが起動時に生成したDifyAgentを使い回す（HTTP接続も維持される）
+        dify_agent = line_dify.get_agent(agent_key)
+
+        # DifyAgentを使用して会話を進行
+        conversation_id, response_text, data = await dify_agent.invoke(
+            conversation_session.conversation_id,
+            text=message.text,
+            inputs={}
         )
-    )
 
-    return []
+        # セッション情報を更新
+        conversation_session.conversation_id = conversation_id
+
+        # 応答メッセージを生成（sender情報を含める）
+        reply_message = TextMessage(
+            text=response_text,
+            sender=SENDER_BY_AGENT[agent_key]
+        )
+        reply_error, saved = await reply_and_save(event.reply_token, conversation_session, reply_message)
+        dirty = not saved
+        if reply_error:
+            raise reply_error
+
+        return []
+
+    finally:
+        # 返信前に中断した場合や保存に失敗した場合も、変更済みのセッションは保存する
+        if dirty:
+            await line_dify.conversation_session_store.set_session(conversation_session)
 
 # make_inputs 関数を追加（必要に応じて）
 @line_dify.make_inputs
@@ -171,11 +241,10 @@ async def make_inputs(session: ConversationSession):
 # to_reply_message 関数を追加（必要に応じて）
 @line_dify.to_reply_message
 async def to_reply_message(text: str, data: dict, session: ConversationSession):
-    agent_key = session.agent_key or "Emily"
-    agent_info = DIFY_AGENTS.get(agent_key, DIFY_AGENTS["Emily"])
+    agent_key = session.agent_key if session.agent_key in AVAILABLE_TYPES_SET else "Emily"
     return [TextMessage(
         text=text,
-        sender={"name": agent_key, "iconUrl": agent_info.get("iconUrl")}
+        sender=SENDER_BY_AGENT[agent_key]
     )]
 
 # エラーメッセージのカスタマイズ
@@ -186,12 +255,39 @@ async def to_error_message(event: Event, ex: Exception, session: ConversationSes
 
 # Webhook エンドポイント
 @app.post("/linebot")
-async def handle_request(request: Request, background_tasks: BackgroundTasks):
-    body = (await request.body()).decode("utf-8")
+async def handle_request(request: Request):
+    body = await request.body()
     signature = request.headers.get("X-Line-Signature", "")
-    background_tasks.add_task(
-        line_dify.process_request,
-        request_body=body,
-        signature=signature
-    )
+
+    # 署名が不正なリクエストはキューに入れずに拒否する
+    if not line_dify.verify_signature(body, signature):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # 検証済みのボディをここで一度だけパースし、イベントをそのままワーカーに渡す
+    try:
+        events = line_dify.parse_events(body)
+    except (ValueError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid request body")
+
+    try:
+        request.app.state.webhook_queue.put_nowait(events)
+    except asyncio.QueueFull:
+        logger.warning("Webhookのキューが上限に達したため、リクエストを受け付けませんでした")
+        raise HTTPException(status_code=503, detail="Server busy")
     return "ok"
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # セッションのキャッシュとWebhookのキューはプロセス内にあるため、既定はシングルワーカー
+    # 複数ワーカーの場合はセッションのキャッシュは無効になる。共有のデータベースを使うこと
+    uvicorn.run(
+        "run:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+        log_level=os.getenv("LOG_LEVEL", "INFO").lower()
+    )
@@ -1,5 +1,8 @@
 import pytest
+import asyncio
 import os
+from unittest.mock import Mock
+from aiohttp import StreamReader
 from linedify import DifyAgent, DifyType
 
 @pytest.fixture
@@ -49,6 +52,53 @@ async def test_make_payloads_with_image(dify_agent, image_bytes):
             assert v == expected_payloads_without_image[k]
 
 
+class StreamingResponse:
+    def __init__(self, body: bytes):
+        self.content = StreamReader(Mock(_reading_paused=False), 2 ** 16, loop=asyncio.get_running_loop())
+        # Feed byte by byte while the response is being read so that SSE frames
+        # (and "\n\n" / "\r\n") are split across reads
+        self.feeder = asyncio.get_running_loop().create_task(self.feed(body))
+
+    async def feed(self, body: bytes):
+        for i in range(len(body)):
+            self.content.feed_data(body[i:i + 1])
+            await asyncio.sleep(0)
+        self.content.feed_eof()
+
+
+@pytest.mark.asyncio
+async def test_process_agent_response(dify_agent):
+    body = (
+        'data: {"event": "agent_thought", "conversation_id": "conv1"}\n\n'
+        'data: {"event": "message", "answer": "こんにちは", "conversation_id": "conv1"}\n\n'
+        ': keepalive\n\n'
+        'data: {"event": "message", "answer": "、世界", "conversation_id": "conv1"}\n\n'
+        'data: {"event": "message",\ndata: "answer": "！", "conversation_id": "conv1"}\n\n'
+        'data: {"event": "message_end", "conversation_id": "conv1", "metadata": {"usage": {"total_tokens": 10}}}'
+    ).encode("utf-8")
+
+    conversation_id, response_text, response_data = await dify_agent.process_agent_response(StreamingResponse(body))
+
+    assert conversation_id == "conv1"
+    assert response_text == "こんにちは、世界！"
+    assert response_data == {"metadata": {"usage": {"total_tokens": 10}}}
+
+    # CRLF line endings are also valid in SSE
+    conversation_id, response_text, response_data = await dify_agent.process_agent_response(StreamingResponse(body.replace(b"\n", b"\r\n")))
+
+    assert conversation_id == "conv1"
+    assert response_text == "こんにちは、世界！"
+    assert response_data == {"metadata": {"usage": {"total_tokens": 10}}}
+
+
+@pytest.mark.asyncio
+async def test_process_agent_response_error(dify_agent):
+    body = b'data: {"event": "error", "message": "Something went wrong"}\n\n'
+
+    with pytest.raises(Exception, match="Something went wrong"):
+        await dify_agent.process_agent_response(StreamingResponse(body))
+
+
 @pytest.mark.asyncio
 async def test_invoke(dify_agent):
     conversation_id, response_text, response_data = await dify_agent.invoke(conversation_id=None, text="This is a test. Respond success.")
@@ -1,6 +1,10 @@
 import pytest
+import base64
+import hashlib
+import hmac
 import json
 import os
+from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, PostbackEvent, FollowEvent, ImageMessageContent, StickerMessageContent, LocationMessageContent, ContentProvider
 from linebot.v3.messaging import TextMessage
 from linedify import LineDify, DifyType
@@ -189,3 +193,60 @@ async def test_to_error_message(line_dify):
 
     reply_messages = await line_dify.process_event(to_message_event("hello"))
     assert reply_messages[0].text == "Custom error message"
+
+
+@pytest.mark.asyncio
+async def test_parse_events():
+    ld = LineDify(
+        line_channel_access_token="channel_access_token",
+        line_channel_secret="channel_secret",
+        dify_agents={"default": {"api_key": "api_key", "base_url": "http://localhost", "user": "user"}},
+        session_db_url="sqlite://"
+    )
+    body = '{"destination": "xxxxxxxxxx", "events": [{"deliveryContext": {"isRedelivery": false}, "message": {"id": "521033363122028567", "text": "こんにちは", "type": "text", "quoteToken": "XXXXXX"}, "mode": "active", "replyToken": "7d34442b4f0c4f319f721ed6293fb70f", "source": {"type": "user", "userId": "U1234xx5f678x90x123456x78x9012xx3"}, "timestamp": 1723391389452, "type": "message", "webhookEventId": "01J5123C4954D0284W9KN11QCX"}]}'.encode("utf-8")
+    signature = base64.b64encode(hmac.new(b"channel_secret", body, hashlib.sha256).digest()).decode("utf-8")
+
+    assert ld.verify_signature(body, signature) is True
+    assert ld.verify_signature(body, "invalid") is False
+
+    events = ld.parse_events(body)
+    assert len(events) == 1
+    assert isinstance(events[0], MessageEvent)
+    assert events[0].message.text == "こんにちは"
+
+    # Malformed bodies are rejected as ValueError
+    for invalid_body in [b"[1]", b"{}", b'{"events": {}}', b'{"events": [1]}', b"not json"]:
+        with pytest.raises(ValueError):
+            ld.parse_events(invalid_body)
+
+    with pytest.raises(InvalidSignatureError):
+        await ld.process_request(body, "invalid")
+
+    # Signature check is skipped for bodies verified at the endpoint
+    await ld.process_request(b'{"destination": "xxxxxxxxxx", "events": []}', "invalid", verified=True)
+
+    await ld.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_process_events_skips_duplicates():
+    ld = LineDify(
+        line_channel_access_token="channel_access_token",
+        line_channel_secret="channel_secret",
+        dify_agents={"default": {"api_key": "api_key", "base_url": "http://localhost", "user": "user"}},
+        session_db_url="sqlite://"
+    )
+    body = '{"destination": "xxxxxxxxxx", "events": [{"type": "follow", "mode": "active", "timestamp": 1723391389452, "source": {"type": "user", "userId": "U1234xx5f678x90x123456x78x9012xx3"}, "webhookEventId": "01J5123C4954D0284W9KN11QCX", "deliveryContext": {"isRedelivery": false}}]}'.encode("utf-8")
+
+    processed = []
+
+    @ld.event("follow")
+    async def handle_follow_event(event):
+        processed.append(event.webhook_event_id)
+
+    await ld.process_events(ld.parse_events(body))
+    # Redelivered event with the same webhookEventId
+    await ld.process_events(ld.parse_events(body))
+    assert processed == ["01J5123C4954D0284W9KN11QCX"]
+
+    await ld.shutdown()
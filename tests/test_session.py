@@ -24,6 +24,16 @@ def test_conversation_session():
     assert session2.conversation_id == session.conversation_id
     assert session2.updated_at == session.updated_at
 
+    # ISO format string follows updated_at
+    assert session.updated_at_iso == now.isoformat()
+    later = datetime.now(timezone.utc)
+    session.updated_at = later
+    assert session.updated_at_iso == later.isoformat()
+    assert session.to_dict()["updated_at"] == later.isoformat()
+
+    # Slotted to keep cached sessions small
+    assert not hasattr(session, "__dict__")
+
 
 @pytest.mark.asyncio
 async def test_conversation_session_store():
@@ -82,3 +92,52 @@ async def test_conversation_session_store():
     assert sessions[-1].user_id == "user_id"
     assert sessions[-1].conversation_id == conversation_id3
     assert sessions[-1].updated_at > sessions[-2].updated_at
+
+
+@pytest.mark.asyncio
+async def test_conversation_session_store_cache():
+    store = ConversationSessionStore("sqlite:///test_sessions.db", 3, cache_size=10)
+    await store.expire_session("cache_user_id")
+
+    session = await store.get_session("cache_user_id")
+    session.conversation_id = str(uuid4())
+    await store.set_session(session)
+    assert "cache_user_id" in store.cache
+
+    # Served from cache as a copy
+    session2 = await store.get_session("cache_user_id")
+    assert session2 is not session
+    assert session2.conversation_id == session.conversation_id
+    session2.conversation_id = "modified"
+    assert (await store.get_session("cache_user_id")).conversation_id == session.conversation_id
+
+    # Same result from database
+    store.cache.clear()
+    session3 = await store.get_session("cache_user_id")
+    assert session3.conversation_id == session.conversation_id
+
+    # Expire invalidates cache
+    await store.expire_session("cache_user_id")
+    assert "cache_user_id" not in store.cache
+    session4 = await store.get_session("cache_user_id")
+    assert session4.conversation_id is None
+
+
+@pytest.mark.asyncio
+async def test_conversation_session_store_in_memory_concurrency():
+    # In-memory SQLite shares one connection across worker threads
+    store = ConversationSessionStore("sqlite://")
+
+    async def converse(user_id: str):
+        for i in range(20):
+            session = await store.get_session(user_id)
+            session.conversation_id = f"{user_id}-{i}"
+            await store.set_session(session)
+
+    user_ids = [f"user_{i}" for i in range(30)]
+    await asyncio.gather(*(converse(user_id) for user_id in user_ids))
+
+    for user_id in user_ids:
+        assert (await store.get_session(user_id)).conversation_id == f"{user_id}-19"
+
+    await store.close()